@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
-import re, requests, threading, time
+import base64, bisect, collections, gzip, hashlib, heapq, hmac, json, os, re, requests, threading, time
+from urllib.parse import urlencode, urlsplit
 try:
     import unicodedata
     from unidecode import unidecode
 except:
     pass
+try:
+    import httpx
+except:
+    pass
+try:
+    import brotli
+except:
+    try:
+        import brotlicffi as brotli
+    except:
+        pass
 
 class VoatConnectionError(Exception):
     """ Raised when Voat returns a page in HTML format
@@ -52,14 +64,536 @@ class VoatAPICallError(Exception):
     """
     pass
 
+class VoatCassetteError(Exception):
+    """ Raised when a replayed request has no recorded response
+
+     * args[0] is a dict containing: "message" and "data", data is the
+       request key that could not be served
+    """
+    pass
+
+def accept_encoding():
+    """ Returns the Accept-Encoding header value for the compression
+    schemes that can be decoded with the installed libraries
+    """
+    if "brotli" in globals():
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+def _request_key(method, url, params=None):
+    """ Returns the string used to match requests, it contains the
+    method, the URL and the sorted GET parameters """
+    url = str(url)
+    if params:
+        url += ("&" if "?" in url else "?") + urlencode(sorted(params.items()))
+    return "{} {}".format(method.upper(), url)
+
+def _encoded_body(json_data=None, form_data=None):
+    """ Returns a request body encoded the way it is sent """
+    if json_data is not None:
+        return json.dumps(json_data).encode("utf-8")
+    if form_data:
+        return urlencode(form_data).encode("utf-8")
+    return b""
+
+class VoatResponse(object):
+    """ Minimal response object returned by in-process transports
+
+    It has the attributes used by the clients: status_code, headers,
+    url, content, wire_bytes, text and json()
+    """
+    def __init__(self, status_code=200, content=b"", headers=None, url="",
+        wire_bytes=None):
+        """ Initialize self
+
+         * status_code: HTTP status code
+         * content: response body, bytes or str
+         * headers: dict containing response headers
+         * url: final URL of the request
+         * wire_bytes: body size as sent on the wire, the length of
+           content if it is None
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        self.status_code = status_code
+        self.content = content
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.url = url
+        self.wire_bytes = len(content) if wire_bytes is None else wire_bytes
+    @property
+    def ok(self):
+        return self.status_code < 400
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+    def json(self):
+        return json.loads(self.text)
+    def __repr__(self):
+        return "<VoatResponse [{}]>".format(self.status_code)
+
+class VoatTransport(object):
+    """ Base transport class
+
+    A transport sends HTTP requests on behalf of VoatAPIClient and keeps
+    connection and traffic statistics. Subclasses implement request()
+    """
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "bytes_decoded": 0,
+        }
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        """ Sends a request and returns a response object with
+        status_code, headers, url, content, text and json(). Transports
+        also set wire_bytes on it: the size of the body as sent on the
+        wire, that is, before decompression
+
+         * method: GET, POST, PUT or DELETE
+         * url: full URL
+         * params: dict containing GET parameters and their values
+         * json: object to send as a JSON body
+         * data: dict to send as a form encoded body
+         * headers: dict containing request headers
+         * allow_redirects: follow redirections if True
+        """
+        raise NotImplementedError
+    def get_stats(self):
+        """ Returns a copy of the statistics dict
+
+         * requests: number of calls to request(), a call that follows
+           redirections counts once
+         * connections_opened: number of connections established
+         * connections_reused: number of HTTP exchanges, redirections
+           included, sent over an already established connection
+         * bytes_sent: request body bytes, redirections included
+         * bytes_received: response body bytes as sent on the wire, that
+           is, before decompression, redirections included
+         * bytes_decoded: response body bytes after decompression,
+           redirections included
+        """
+        with self._stats_lock:
+            return dict(self.stats)
+    def _count(self, **counters):
+        with self._stats_lock:
+            for k, v in counters.items():
+                self.stats[k] += v
+    def _count_in_process(self, ret, sent=0):
+        """ Counts a response served without network access as if every
+        request was sent over a single connection
+        """
+        with self._stats_lock:
+            reused = 1 if self.stats["requests"] else 0
+            self.stats["requests"] += 1
+            self.stats["connections_opened"] += 1 - reused
+            self.stats["connections_reused"] += reused
+            self.stats["bytes_sent"] += sent
+            self.stats["bytes_received"] += ret.wire_bytes
+            self.stats["bytes_decoded"] += len(ret.content)
+    def close(self):
+        """ Closes the underlying connections """
+        pass
+
+class _CountingPoolMixin(object):
+    """ urllib3 connection pool mixin that tells its transport whether
+    each HTTP exchange used a new or an already established connection
+    """
+    transport = None
+    def _make_request(self, conn, *args, **kwargs):
+        if getattr(conn, "_voat_used", False):
+            self.transport._count(connections_reused=1)
+        else:
+            conn._voat_used = True
+            self.transport._count(connections_opened=1)
+        return super(_CountingPoolMixin, self)._make_request(conn, *args, **kwargs)
+
+class VoatRequestsTransport(VoatTransport):
+    """ HTTP/1.1 transport based on requests.Session, this is the default
+    transport
+    """
+    def __init__(self, session=None):
+        """ Initialize self
+
+         * session: requests.Session to use, a new one is created if it
+           is None. Connections are counted for the pools created after
+           this, by the adapters mounted at this point
+        """
+        super(VoatRequestsTransport, self).__init__()
+        self.session = session if session is not None else requests.Session()
+        for adapter in self.session.adapters.values():
+            self._count_connections(adapter)
+    def _count_connections(self, adapter):
+        """ Makes the connection pools created by adapter report to self """
+        poolmanager = getattr(adapter, "poolmanager", None)
+        if poolmanager is None:
+            return
+        poolmanager.pool_classes_by_scheme = dict(
+            (scheme, type(cls.__name__, (_CountingPoolMixin, cls), {"transport": self}))
+            for scheme, cls in poolmanager.pool_classes_by_scheme.items()
+        )
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        ret = self.session.request(method, url, params=params, json=json,
+            data=data, headers=headers, allow_redirects=allow_redirects)
+        sent = received = decoded = 0
+        for r in ret.history + [ret]:
+            sent += len(r.request.body or b"")
+            try:
+                r.wire_bytes = r.raw.tell()
+            except Exception:
+                r.wire_bytes = len(r.content)
+            received += r.wire_bytes
+            decoded += len(r.content)
+        self._count(requests=1, bytes_sent=sent, bytes_received=received,
+            bytes_decoded=decoded)
+        return ret
+    def close(self):
+        self.session.close()
+
+class VoatHTTP2Transport(VoatTransport):
+    """ HTTP/2 transport based on httpx
+
+    The transport is thread safe, concurrent calls made from several
+    threads are multiplexed over a single connection. Requires httpx with
+    HTTP/2 support: pip install httpx[http2]
+    """
+    def __init__(self, client=None, **kwargs):
+        """ Initialize self
+
+         * client: httpx.Client to use, a new HTTP/2 client is created if
+           it is None
+         * kwargs: extra arguments for httpx.Client, like timeout or
+           limits
+        """
+        if "httpx" not in globals():
+            raise ImportError("VoatHTTP2Transport requires httpx, install it with: pip install httpx[http2]")
+        super(VoatHTTP2Transport, self).__init__()
+        self.client = client if client is not None else httpx.Client(http2=True, **kwargs)
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        opened = []
+        def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                opened.append(event)
+        ret = self.client.request(method, url, params=params, json=json,
+            data=data, headers=headers, follow_redirects=allow_redirects,
+            extensions={"trace": trace})
+        hops = ret.history + [ret]
+        for r in hops:
+            r.wire_bytes = r.num_bytes_downloaded
+        self._count(requests=1, connections_opened=len(opened),
+            connections_reused=max(len(hops) - len(opened), 0),
+            bytes_sent=sum(int(r.request.headers.get("Content-Length", 0))
+                for r in hops),
+            bytes_received=sum(r.wire_bytes for r in hops),
+            bytes_decoded=sum(len(r.content) for r in hops))
+        return ret
+    def close(self):
+        self.client.close()
+
+class VoatFakeTransport(VoatTransport):
+    """ In-process transport for testing, no network access is performed
+
+    Responses are registered with add_response() or produced by a
+    handler function. Registered responses are matched by method, URL
+    and GET parameters, responses registered without parameters match
+    any parameters. Every request is appended to the requests list as
+    a dict containing: "method", "url", "params", "json", "data" and
+    "headers"
+    """
+    def __init__(self, handler=None):
+        """ Initialize self
+
+         * handler: function receiving the request dict and returning a
+           VoatResponse, used when no registered response matches
+        """
+        super(VoatFakeTransport, self).__init__()
+        self.handler = handler
+        self.routes = {}
+        self.requests = []
+    def add_response(self, method, url, json_data=None, status_code=200,
+        headers=None, content=None, params=None):
+        """ Registers a response for a method and URL, several responses
+        for the same request are served in order and the last one is
+        repeated
+
+         * json_data: object returned as a JSON body
+         * content: raw body, used if json_data is None
+         * params: dict containing the GET parameters to match
+        """
+        if json_data is not None:
+            content = json.dumps(json_data)
+            headers = dict({"Content-Type": "application/json"}, **(headers or {}))
+        response = VoatResponse(status_code, content or b"", headers, url)
+        self.routes.setdefault(_request_key(method, url, params), []).append(response)
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        req = {
+            "method": method.upper(),
+            "url": str(url),
+            "params": params,
+            "json": json,
+            "data": data,
+            "headers": dict(headers or {})
+        }
+        self.requests.append(req)
+        responses = (self.routes.get(_request_key(method, url, params)) or
+            self.routes.get(_request_key(method, url)))
+        if responses:
+            ret = responses.pop(0) if len(responses) > 1 else responses[0]
+        elif self.handler is not None:
+            ret = self.handler(req)
+        else:
+            ret = VoatResponse(404, "Not Found", url=req["url"])
+        self._count_in_process(ret, len(_encoded_body(json, data)))
+        return ret
+
+_auth_paths = ("/oauth/authorize", "/oauth/token", "/account/login")
+
+def _is_auth_request(url, form_data=None):
+    """ Returns True for the OAuth2 and log in requests, the only ones
+    sent form encoded, their bodies and responses contain credentials
+    """
+    if form_data is not None:
+        return True
+    return urlsplit(str(url)).path.lower().rstrip("/") in _auth_paths
+
+def _body_hash(salt, url, json_data=None, form_data=None):
+    """ Returns a keyed hash of a request body, bodies are never stored in
+    cassettes. Authentication requests are not hashed at all since their
+    bodies contain the password and the client secret
+    """
+    body = json_data if json_data is not None else form_data
+    if body is None or _is_auth_request(url, form_data):
+        return None
+    body = json.dumps(body, sort_keys=True, default=str)
+    return hmac.new(salt.encode("ascii"), body.encode("utf-8"),
+        hashlib.sha256).hexdigest()
+
+def _is_conditional(headers):
+    """ Returns True if headers contain revalidation validators """
+    return any(k.lower() in ("if-none-match", "if-modified-since")
+        for k in (headers or {}))
+
+def _scrub_code(text):
+    """ Redacts OAuth2 authorization codes from a URL """
+    return re.sub(r'([?&]code=)[^&#]*', r'\1REDACTED', text)
+
+def _scrub_hidden_input(m):
+    """ Redacts the value of a hidden <input> tag matched by re.sub """
+    tag = m.group(0)
+    if not re.search(r'\btype\s*=\s*["\']?hidden\b', tag, re.I):
+        return tag
+    return re.sub(r'(\bvalue\s*=\s*)("[^"]*"|\'[^\']*\'|[^\s>]+)',
+        r'\1"REDACTED"', tag, flags=re.I)
+
+class VoatRecordingTransport(VoatTransport):
+    """ Transport that records request/response pairs and their timing
+    to a cassette file that can be served by VoatReplayTransport
+
+    Cassettes are gzipped JSON lines files, the first line contains the
+    cassette salt. Request headers and bodies are not stored, only a
+    hash of the body keyed with the salt (authentication request bodies
+    are not hashed). Response bodies are stored except for these
+    secrets, which are redacted: access_token and refresh_token values,
+    authorization codes in URLs and Location headers, and hidden form
+    fields of the log in pages. Call save() or close() when done, or use
+    it as a context manager
+    """
+    _skip_headers = ("content-encoding", "content-length", "transfer-encoding",
+        "connection", "set-cookie")
+    def __init__(self, path, transport=None):
+        """ Initialize self
+
+         * path: cassette file name
+         * transport: VoatTransport that performs the real requests, a
+           VoatRequestsTransport is used if it is None
+        """
+        super(VoatRecordingTransport, self).__init__()
+        self.path = path
+        self.transport = transport if transport is not None else VoatRequestsTransport()
+        self.interactions = []
+        self.salt = base64.b64encode(os.urandom(16)).decode("ascii")
+        self._lock = threading.Lock()
+        self._start = None
+    def _scrub_body(self, url, form_data, body):
+        """ Redacts tokens and hidden form fields from an authentication
+        response body
+        """
+        if not _is_auth_request(url, form_data):
+            return body
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return re.sub(r'<input\b[^>]*>', _scrub_hidden_input, body)
+        if isinstance(data, dict):
+            for k in ("access_token", "refresh_token"):
+                if k in data:
+                    data[k] = "REDACTED"
+        return json.dumps(data)
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        start = time.time()
+        ret = self.transport.request(method, url, params=params, json=json,
+            data=data, headers=headers, allow_redirects=allow_redirects)
+        elapsed = time.time() - start
+        try:
+            body = self._scrub_body(url, data, ret.content.decode("utf-8"))
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            body, encoding = base64.b64encode(ret.content).decode("ascii"), "base64"
+        with self._lock:
+            if self._start is None:
+                self._start = start
+            self.interactions.append({
+                "request": _scrub_code(_request_key(method, url, params)),
+                "body_hash": _body_hash(self.salt, url, json, data),
+                "conditional": _is_conditional(headers),
+                "status": ret.status_code,
+                "url": _scrub_code(str(ret.url)),
+                "headers": dict((k, _scrub_code(v)) for k, v in ret.headers.items()
+                    if k.lower() not in self._skip_headers),
+                "body": body,
+                "encoding": encoding,
+                "wire_bytes": getattr(ret, "wire_bytes", len(ret.content)),
+                "offset": round(start - self._start, 6),
+                "elapsed": round(elapsed, 6)
+            })
+        return ret
+    def get_stats(self):
+        return self.transport.get_stats()
+    def save(self):
+        """ Writes the recorded interactions to the cassette file """
+        with self._lock:
+            interactions = list(self.interactions)
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({"salt": self.salt}) + "\n")
+            for interaction in interactions:
+                f.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+    def close(self):
+        self.save()
+        self.transport.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+class VoatReplayTransport(VoatTransport):
+    """ Transport that serves the responses stored in a cassette recorded
+    by VoatRecordingTransport, no network access is performed
+
+    Requests are matched by method, URL, GET parameters, whether they
+    carried revalidation validators (so an unconditional request is
+    never served a recorded 304) and body hash if match_body is True.
+    Repeated requests get the recorded responses in order. Redacted secrets are served as the string
+    REDACTED
+    """
+    def __init__(self, path, latency_scale=None, match_body=False, loop=True,
+        pace=False):
+        """ Initialize self
+
+         * path: cassette file name
+         * latency_scale: None or 0 to answer immediately, 1 to reproduce
+           the recorded latencies, greater values to scale them up
+         * match_body: also match requests by body hash
+         * pace: if True each response is held until its recorded start
+           time, relative to the first replayed request and scaled by
+           latency_scale (or 1 if it is not set), reproducing the
+           original timing between requests
+         * loop: start over from the first recorded response when all
+           responses for a request have been served, if False
+           VoatCassetteError is raised instead
+        """
+        super(VoatReplayTransport, self).__init__()
+        self.path = path
+        self.latency_scale = latency_scale
+        self.match_body = match_body
+        self.loop = loop
+        self.pace = pace
+        self.salt = ""
+        self.interactions = {}
+        self._served = {}
+        self._start = None
+        self._lock = threading.Lock()
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    if "request" not in interaction:
+                        self.salt = interaction.get("salt", "")
+                        continue
+                    key = self._key(interaction["request"], interaction["body_hash"],
+                        interaction.get("conditional", False))
+                    self.interactions.setdefault(key, []).append(interaction)
+    def _key(self, request, body_hash, conditional):
+        if self.match_body:
+            return (request, body_hash, conditional)
+        return (request, None, conditional)
+    def request(self, method, url, params=None, json=None, data=None,
+        headers=None, allow_redirects=True):
+        key = self._key(_request_key(method, url, params),
+            _body_hash(self.salt, url, json, data), _is_conditional(headers))
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+            recorded = self.interactions.get(key)
+            if not recorded:
+                raise VoatCassetteError({
+                    "message": "Request not found in cassette",
+                    "data": key[0]
+                })
+            i = self._served.get(key, 0)
+            if i >= len(recorded):
+                if not self.loop:
+                    raise VoatCassetteError({
+                        "message": "All recorded responses for this request were served",
+                        "data": key[0]
+                    })
+                i = 0
+            self._served[key] = i + 1
+            interaction = recorded[i]
+        if self.pace:
+            wait = self._start + interaction["offset"] * (self.latency_scale or 1) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        if self.latency_scale:
+            time.sleep(interaction["elapsed"] * self.latency_scale)
+        body = interaction["body"]
+        if interaction["encoding"] == "base64":
+            body = base64.b64decode(body)
+        ret = VoatResponse(interaction["status"], body, interaction["headers"],
+            interaction["url"], interaction.get("wire_bytes"))
+        self._count_in_process(ret, len(_encoded_body(json, data)))
+        return ret
+
 class VoatAPIClient(object):
-    """ Base API client class """
-    def __init__(self, apiPath, domain="voat.co"):
+    """ Base API client class
+
+    GET calls are revalidated: ETag and Last-Modified validators are kept
+    per URL and sent back as If-None-Match and If-Modified-Since, a 304
+    response returns the stored body. Set conditional_requests to False
+    to disable it. revalidation_stats contains:
+
+     * conditional_requests: GET calls sent with validators
+     * not_modified: 304 responses served from the stored body
+     * bytes_saved: body bytes, as sent on the wire, not downloaded
+       thanks to 304s
+     * unchanged: 200 responses identical to the previous one, detected
+       by content hash
+    """
+    def __init__(self, apiPath, domain="voat.co", transport=None):
         """ Initialize self
 
          * apiPath: api/ for the old API and api/v1/ for the new API
          * domain: usually voat.co but can be api-preview.voat.co for
            testing the new API
+         * transport: VoatTransport instance used to send requests, a
+           VoatRequestsTransport is used if it is None
         """
         if not apiPath.endswith("/"):
             apiPath = apiPath + "/"
@@ -67,8 +601,8 @@ class VoatAPIClient(object):
         self.prepend_path = apiPath
         self._headers = {
             "Accept": "*/*",
+            "Accept-Encoding": accept_encoding(),
             "Accept-Language": "en-US,en;q=0.8",
-            "Connection": "keep-alive",
             "Host": self.domain,
             "Origin": "https://{}".format(self.domain),
             "Referer": "https://{}/".format(self.domain),
@@ -76,7 +610,18 @@ class VoatAPIClient(object):
             "DNT": "1",
             "Content-Type": "application/json; charset=UTF-8",
         }
-        self.session = requests.Session()
+        self.transport = transport if transport is not None else VoatRequestsTransport()
+        self.session = getattr(self.transport, "session", None)
+        self.conditional_requests = True
+        self.max_validators = 256
+        self.revalidation_stats = {
+            "conditional_requests": 0,
+            "not_modified": 0,
+            "bytes_saved": 0,
+            "unchanged": 0,
+        }
+        self._validators = collections.OrderedDict()
+        self._validators_lock = threading.Lock()
     def get_url(self, path=""):
         """ Generate a full URL from a path """
         return "https://{}/{}".format(self.domain, path)
@@ -91,19 +636,28 @@ class VoatAPIClient(object):
          * method: method to use, can be GET, POST, PUT or DELETE
         """
         path = self.prepend_path + path
-        fn = {
-            "GET": self.session.get,
-            "POST": self.session.post,
-            "PUT": self.session.put,
-            "DELETE": self.session.delete
-        }[method.upper()]
-        if data is None:
-            ret = fn(self.get_url(path), params=params, headers=self._headers)
-        else:
-            ret = fn(self.get_url(path), params=params, json=data,
-                headers=self._headers)
+        url = self.get_url(path)
+        headers = self._headers
+        key = None
+        if self.conditional_requests and method.upper() == "GET":
+            key = _request_key("GET", url, params)
+            headers = self._conditional_headers(key)
+        ret = self.transport.request(method.upper(), url, params=params,
+            json=data, headers=headers)
+        body = None
+        if key is not None:
+            body = self._revalidate(key, ret)
+            if body is None and ret.status_code == 304:
+                # The stored body is gone (evicted, or a replayed 304),
+                # fetch the whole response again
+                ret = self.transport.request("GET", url, params=params,
+                    headers=self._headers)
+                body = self._revalidate(key, ret)
         try:
-            ret = ret.json()
+            if body is not None:
+                ret = json.loads(body)
+            else:
+                ret = ret.json()
         except Exception as e:
             raise VoatConnectionError({
                 "message": "Unexpected (server?) error",
@@ -111,15 +665,80 @@ class VoatAPIClient(object):
                 "args": e.args
             })
         return ret
+    def _conditional_headers(self, key):
+        """ Returns the request headers with the stored validators for
+        key, if any
+        """
+        with self._validators_lock:
+            entry = self._validators.get(key)
+            if entry is None or entry["body"] is None:
+                return self._headers
+            self.revalidation_stats["conditional_requests"] += 1
+            headers = self._headers.copy()
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+    def _revalidate(self, key, ret):
+        """ Updates the validators for key from a GET response, returns the
+        stored body on 304 Not Modified and None otherwise
+        """
+        with self._validators_lock:
+            entry = self._validators.get(key)
+            if ret.status_code == 304 and entry is not None and entry["body"] is not None:
+                self._validators.move_to_end(key)
+                entry["unchanged"] = True
+                self.revalidation_stats["not_modified"] += 1
+                self.revalidation_stats["bytes_saved"] += entry["wire_bytes"]
+                return entry["body"]
+            if ret.status_code != 200:
+                return None
+            digest = hashlib.sha1(ret.content).hexdigest()
+            unchanged = entry is not None and entry["hash"] == digest
+            if unchanged:
+                self.revalidation_stats["unchanged"] += 1
+            etag = ret.headers.get("ETag")
+            last_modified = ret.headers.get("Last-Modified")
+            self._validators[key] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "hash": digest,
+                # Bodies are only kept when they can be revalidated
+                "body": ret.content if etag or last_modified else None,
+                "wire_bytes": getattr(ret, "wire_bytes", len(ret.content)),
+                "unchanged": unchanged
+            }
+            self._validators.move_to_end(key)
+            while len(self._validators) > self.max_validators:
+                self._validators.popitem(last=False)
+        return None
+    def response_unchanged(self, path="", params=None):
+        """ Returns True if the last GET call to path returned the same
+        payload as the one before it (either a 304 response or an
+        identical content hash), False if it changed and None if path
+        has not been called at least once
+
+         * path: the relative path of the API call, minus the api/ or
+           api/v1/ part
+         * params: dict containing GET parameters and their values
+        """
+        key = _request_key("GET", self.get_url(self.prepend_path + path), params)
+        with self._validators_lock:
+            entry = self._validators.get(key)
+            if entry is None:
+                return None
+            return entry["unchanged"]
 
 class VoatLegacyClient(VoatAPIClient):
     """ Legacy API client class """
-    def __init__(self, domain="voat.co"):
+    def __init__(self, domain="voat.co", transport=None):
         """ Initialize self
 
          * domain: usually voat.co but can also be api-preview.voat.co
+         * transport: VoatTransport instance used to send requests
         """
-        super(VoatLegacyClient, self).__init__("api/")
+        super(VoatLegacyClient, self).__init__("api/", transport=transport)
 
     def get_default_subverses(self):
         """ This API returns a list of default subverses shown to
@@ -185,7 +804,8 @@ class VoatClient(VoatAPIClient):
     specified otherwise
     """
     def __init__(self, apikey, secret=None, username=None, password=None,
-        third_party=False, auth_data=None, domain="api.voat.co", autoclean_titles=True):
+        third_party=False, auth_data=None, domain="api.voat.co", autoclean_titles=True,
+        transport=None):
         """ Initialize self
 
          * apikey: your public API key
@@ -209,8 +829,11 @@ class VoatClient(VoatAPIClient):
            whitespace and unprintable characters. Warning: it does not
            produce good results when cleaning titles that use the
            cyrillic alphabet
+         * transport: VoatTransport instance used to send requests, use
+           VoatHTTP2Transport to multiplex concurrent calls over a single
+           HTTP/2 connection or VoatFakeTransport for testing
         """
-        super(VoatClient, self).__init__("api/v1/", domain)
+        super(VoatClient, self).__init__("api/v1/", domain, transport)
         self.apikey = apikey
         self.secret = secret
         self.autoclean_titles = autoclean_titles
@@ -224,7 +847,7 @@ class VoatClient(VoatAPIClient):
             if third_party:
                 headers = self._headers.copy()
                 headers["Content-Type"] = "text/html; charset=UTF-8"
-                s = self.session.get(self.get_url("oauth/authorize"),
+                s = self.transport.request("GET", self.get_url("oauth/authorize"),
                     params={
                         "response_type": "code",
                         "scope": "account",
@@ -245,7 +868,7 @@ class VoatClient(VoatAPIClient):
                         "type": "invalid key"
                     })
                 del headers["Content-Type"]
-                s = self.session.post(s.url,
+                s = self.transport.request("POST", s.url,
                     data={
                         "username": username,
                         "password": password,
@@ -258,7 +881,7 @@ class VoatClient(VoatAPIClient):
                         "data": s,
                         "type": "invalid password"
                     })
-                s = self.session.post(s.url, data={"submit.Grant": "Grant"},
+                s = self.transport.request("POST", s.url, data={"submit.Grant": "Grant"},
                     headers=headers, allow_redirects=False)
                 m = re.match(r'^.*?\?code=(.*)$', s.headers.get("Location", ""))
                 if not m:
@@ -269,7 +892,7 @@ class VoatClient(VoatAPIClient):
                     })
                 self.authorization_code = m.group(1)
                 headers["Content-Type"] = "text/html; charset=UTF-8"
-                s = self.session.post(self.get_url("oauth/token"),
+                s = self.transport.request("POST", self.get_url("oauth/token"),
                     data={
                         "grant_type": "authorization_code",
                         "code": self.authorization_code,
@@ -284,7 +907,7 @@ class VoatClient(VoatAPIClient):
             else:
                 headers = self._headers.copy()
                 headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
-                data = self.session.post(self.get_url("oauth/token"),
+                data = self.transport.request("POST", self.get_url("oauth/token"),
                     data={
                         "grant_type": "password",
                         "username": username,
@@ -403,7 +1026,7 @@ class VoatClient(VoatAPIClient):
             refresh_token = self.auth_data["refresh_token"]
         headers = self._headers.copy()
         headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
-        data = self.session.post(self.get_url("oauth/token"),
+        data = self.transport.request("POST", self.get_url("oauth/token"),
             data={
                 "grant_type":"refresh_token",
                 "refresh_token":refresh_token,
@@ -736,3 +1359,267 @@ class VoatClient(VoatAPIClient):
         if subverse is not None:
             return self.call("stream/comments/v/{}".format(subverse))
         return self.call("stream/comments")
+
+class VoatSubverseCatalog(object):
+    """ Local subverse catalog with prefix and n-gram indexes
+
+    The catalog is built from get_subverse_top, get_subverse_new,
+    get_subverse_defaults and, if a legacy client is given, the legacy
+    get_top_200_subverses. Searches and autocompletes are answered from
+    memory, the API is only used when there are no local results.
+    """
+    def __init__(self, client, legacy_client=None, max_age=3600,
+        refresh_interval=None, retry_delay=60):
+        """ Initialize self
+
+         * client: a VoatClient instance
+         * legacy_client: a VoatLegacyClient instance, optional
+         * max_age: seconds before a source is considered stale and
+           fetched again by refresh()
+         * refresh_interval: if it is not None a daemon thread will
+           refresh the catalog every refresh_interval seconds, sources
+           older than refresh_interval are considered stale by that
+           thread regardless of max_age
+         * retry_delay: seconds to wait before fetching again a source
+           that failed
+        """
+        self.client = client
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.sources = [
+            ("top", client.get_subverse_top),
+            ("new", client.get_subverse_new),
+            ("defaults", client.get_subverse_defaults),
+        ]
+        if legacy_client is not None:
+            self.sources.append(("top200", legacy_client.get_top_200_subverses))
+        self.last_refresh = {}
+        self.errors = {}
+        self._entries = {}
+        self._names = []
+        self._ngrams = {}
+        self._misses = set()
+        self._lock = threading.RLock()
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+            thread = threading.Thread(target=self._auto_refresh)
+            thread.daemon = True
+            thread.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name.lower() in self._entries
+
+    def _auto_refresh(self):
+        """ Refreshes the catalog forever
+        This is an internal method, it is meant to be called in a
+        daemon thread
+        """
+        while True:
+            try:
+                self.refresh(max_age=self.refresh_interval)
+            except Exception:
+                pass
+            time.sleep(self.refresh_interval)
+
+    @staticmethod
+    def _unwrap(ret):
+        """ Returns the list of subverses contained in an API response """
+        if isinstance(ret, dict):
+            ret = ret.get("data")
+        if not isinstance(ret, list):
+            return []
+        return ret
+
+    @staticmethod
+    def _entry_name(entry):
+        """ Returns the subverse name of a catalog entry or None
+
+        API v1 returns dicts, the legacy API returns either dicts or
+        strings like "Name: pics, Description: ..."
+        """
+        if isinstance(entry, dict):
+            for key in ("name", "Name", "subverse", "Subverse"):
+                if entry.get(key):
+                    return entry[key]
+            return None
+        if isinstance(entry, str):
+            m = re.match(r'^\s*Name:\s*([^,\s]+)', entry)
+            if m:
+                return m.group(1)
+            if re.match(r'^\w+$', entry):
+                return entry
+        return None
+
+    @staticmethod
+    def _grams(text, n=3):
+        """ Returns the set of n-grams of a lowercase string """
+        return set(text[i:i+n] for i in range(len(text) - n + 1))
+
+    def _subscribers(self, key):
+        entry = self._entries[key]
+        if isinstance(entry, dict):
+            return entry.get("subscriberCount") or entry.get("subscribers") or 0
+        return 0
+
+    def add(self, entries):
+        """ Merges subverse entries into the catalog and its indexes,
+        returns the lowercase names of the entries that were merged
+        """
+        keys = []
+        with self._lock:
+            for entry in entries:
+                name = self._entry_name(entry)
+                if not name:
+                    continue
+                key = name.lower()
+                if not isinstance(entry, dict):
+                    entry = {"name": name, "raw": entry}
+                old = self._entries.get(key)
+                if old is None:
+                    self._entries[key] = dict(entry)
+                    bisect.insort(self._names, key)
+                    # Unigrams and bigrams answer the first keystrokes,
+                    # trigrams everything else
+                    for n in (1, 2, 3):
+                        for gram in self._grams(key, n):
+                            self._ngrams.setdefault(gram, set()).add(key)
+                else:
+                    old.update(entry)
+                keys.append(key)
+            if keys:
+                self._misses.clear()
+        return keys
+
+    def refresh(self, force=False, max_age=None):
+        """ Fetches stale sources and merges them into the catalog, returns
+        the names of the sources that were fetched
+
+        A source that fails is skipped, its exception is stored in the
+        errors dict and it is not fetched again for retry_delay seconds
+
+         * force: fetch every source even if it is not stale or it failed
+           recently
+         * max_age: overrides the max_age given when initializing self
+        """
+        if max_age is None:
+            max_age = self.max_age
+        fetched = []
+        now = time.time()
+        for source, fn in self.sources:
+            if not force:
+                if now - self.last_refresh.get(source, 0) < max_age:
+                    continue
+                if source in self.errors and now - self.errors[source][0] < self.retry_delay:
+                    continue
+            try:
+                entries = self._unwrap(fn())
+            except Exception as e:
+                self.errors[source] = (time.time(), e)
+                continue
+            self.add(entries)
+            self.errors.pop(source, None)
+            self.last_refresh[source] = time.time()
+            fetched.append(source)
+        return fetched
+
+    def _rank(self, keys, phrase, limit):
+        """ Sorts keys by exact match, prefix match and subscriber count """
+        key = lambda k: (k != phrase, not k.startswith(phrase),
+            -self._subscribers(k), k)
+        if limit is None:
+            ranked = sorted(keys, key=key)
+        else:
+            ranked = heapq.nsmallest(limit, keys, key=key)
+        return [self._entries[k] for k in ranked]
+
+    def _prefix_keys(self, prefix):
+        """ Returns the lowercase names starting with prefix """
+        i = bisect.bisect_left(self._names, prefix)
+        j = bisect.bisect_left(self._names, prefix + "\U0010ffff", i)
+        return self._names[i:j]
+
+    def _substring_keys(self, phrase):
+        """ Returns the lowercase names containing phrase """
+        if len(phrase) < 3:
+            return self._ngrams.get(phrase, set())
+        grams = sorted(self._grams(phrase),
+            key=lambda g: len(self._ngrams.get(g, ())))
+        candidates = set(self._ngrams.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates &= self._ngrams.get(gram, set())
+        return [k for k in candidates if phrase in k]
+
+    def _remote(self, phrase, match):
+        """ Searches the API for phrase and merges the results into the
+        catalog, returns the lowercase names for which match is True
+
+        Errors are stored in errors["search"] and the API is not searched
+        again for retry_delay seconds
+        """
+        if phrase in self._misses:
+            return []
+        failed = self.errors.get("search")
+        if failed and time.time() - failed[0] < self.retry_delay:
+            return []
+        try:
+            ret = self.client.get_subverse_search(phrase)
+        except Exception as e:
+            self.errors["search"] = (time.time(), e)
+            return []
+        self.errors.pop("search", None)
+        keys = self.add(self._unwrap(ret))
+        keys = [k for k in set(keys) if match(k)]
+        if not keys:
+            with self._lock:
+                self._misses.add(phrase)
+        return keys
+
+    def search(self, phrase, limit=None, remote=True):
+        """ Searches the catalog for subverses whose name contains phrase
+
+         * phrase: text to look for, case insensitive
+         * limit: maximum number of results
+         * remote: if True and nothing is found locally the search is
+           performed by get_subverse_search and its results are added to
+           the catalog
+        """
+        if not self._entries:
+            self.refresh()
+        phrase = phrase.strip().lower()
+        if not phrase:
+            return []
+        with self._lock:
+            # Prefix matches rank first, other matches are only needed
+            # when there are not enough of them
+            keys = self._prefix_keys(phrase)
+            if limit is None or len(keys) < limit:
+                prefixed = set(keys)
+                keys += [k for k in self._substring_keys(phrase)
+                    if k not in prefixed]
+        if not keys and remote:
+            keys = self._remote(phrase, lambda k: phrase in k)
+        return self._rank(keys, phrase, limit)
+
+    def autocomplete(self, prefix, limit=10, remote=True):
+        """ Returns subverses whose name starts with prefix
+
+         * prefix: beginning of the subverse name, case insensitive
+         * limit: maximum number of results
+         * remote: if True and nothing is found locally the API is searched
+           for the prefix and its results are added to the catalog
+        """
+        if not self._entries:
+            self.refresh()
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        with self._lock:
+            keys = self._prefix_keys(prefix)
+        if not keys and remote:
+            keys = self._remote(prefix, lambda k: k.startswith(prefix))
+        return self._rank(keys, prefix, limit)